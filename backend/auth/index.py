@@ -4,96 +4,247 @@ Args: event with httpMethod, body (email/password or googleToken)
 Returns: HTTP response with JWT tokens or error
 """
 
-import json
 import os
 import re
+import time
 from typing import Dict, Any, Optional
 from datetime import datetime, timedelta
 import hashlib
 import secrets
 import base64
+import ctypes
+import hmac
+import orjson
 
 try:
     import psycopg2
     from psycopg2.extras import RealDictCursor
+    from psycopg2.pool import ThreadedConnectionPool
 except ImportError:
     psycopg2 = None
 
+try:
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+except ImportError:
+    PBKDF2HMAC = None
+
+try:
+    from argon2 import PasswordHasher
+    from argon2.exceptions import VerificationError, InvalidHashError
+except ImportError:
+    PasswordHasher = None
+
 DATABASE_URL = os.environ.get('DATABASE_URL')
 JWT_SECRET = os.environ.get('JWT_SECRET', 'default-secret-key')
+_JWT_KEY = JWT_SECRET.encode()
+_JWT_HEADER_B64 = base64.urlsafe_b64encode(b'{"alg":"HS256","typ":"JWT"}').rstrip(b'=')
 GOOGLE_CLIENT_ID = os.environ.get('GOOGLE_CLIENT_ID', '')
 AUTH_GOOGLE_ENABLED = os.environ.get('AUTH_GOOGLE_ENABLED', 'false').lower() == 'true'
+FASTPBKDF2_LIBRARY = os.environ.get('FASTPBKDF2_LIBRARY', '')
 
-def hash_password(password: str) -> str:
+_EMAIL_RE = re.compile(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$')
+
+PBKDF2_ITERATIONS = 100000
+PBKDF2_DKLEN = 32
+
+def _cryptography_pbkdf2(hash_name: str, password: bytes, salt: bytes, iterations: int, dklen: int) -> bytes:
+    kdf = PBKDF2HMAC(algorithm=hashes.SHA256(), length=dklen, salt=salt, iterations=iterations)
+    return kdf.derive(password)
+
+def _load_fastpbkdf2():
+    if not FASTPBKDF2_LIBRARY:
+        return None
+    try:
+        fn = ctypes.CDLL(FASTPBKDF2_LIBRARY).fastpbkdf2_hmac_sha256
+    except (OSError, AttributeError):
+        return None
+    fn.argtypes = [
+        ctypes.c_char_p, ctypes.c_size_t, ctypes.c_char_p, ctypes.c_size_t,
+        ctypes.c_uint32, ctypes.c_char_p, ctypes.c_size_t
+    ]
+    fn.restype = None
+    return fn
+
+_FASTPBKDF2 = _load_fastpbkdf2()
+
+def _fast_pbkdf2(hash_name: str, password: bytes, salt: bytes, iterations: int, dklen: int) -> bytes:
+    out = ctypes.create_string_buffer(dklen)
+    _FASTPBKDF2(password, len(password), salt, len(salt), iterations, out, dklen)
+    return out.raw
+
+_HMAC_TRANS_36 = bytes(x ^ 0x36 for x in range(256))
+_HMAC_TRANS_5C = bytes(x ^ 0x5C for x in range(256))
+
+def _python_pbkdf2(hash_name: str, password: bytes, salt: bytes, iterations: int, dklen: int) -> bytes:
+    # The HMAC key pads depend only on the password, so both SHA-256 states are
+    # built once and copied per iteration instead of re-keying HMAC every round
+    if len(password) > 64:
+        password = hashlib.sha256(password).digest()
+    password = password.ljust(64, b'\0')
+    inner = hashlib.sha256(password.translate(_HMAC_TRANS_36))
+    outer = hashlib.sha256(password.translate(_HMAC_TRANS_5C))
+    
+    def prf(data: bytes) -> bytes:
+        icpy = inner.copy()
+        icpy.update(data)
+        ocpy = outer.copy()
+        ocpy.update(icpy.digest())
+        return ocpy.digest()
+    
+    derived = b''
+    block = 1
+    while len(derived) < dklen:
+        prev = prf(salt + block.to_bytes(4, 'big'))
+        acc = int.from_bytes(prev, 'big')
+        for _ in range(iterations - 1):
+            prev = prf(prev)
+            acc ^= int.from_bytes(prev, 'big')
+        derived += acc.to_bytes(32, 'big')
+        block += 1
+    return derived[:dklen]
+
+# hashlib.pbkdf2_hmac is only OpenSSL-backed when it comes from the _hashlib
+# extension; otherwise prefer cryptography's OpenSSL binding over any Python loop
+if _FASTPBKDF2:
+    _pbkdf2 = _fast_pbkdf2
+elif getattr(getattr(hashlib, 'pbkdf2_hmac', None), '__module__', '') == '_hashlib':
+    _pbkdf2 = hashlib.pbkdf2_hmac
+elif PBKDF2HMAC:
+    _pbkdf2 = _cryptography_pbkdf2
+else:
+    _pbkdf2 = _python_pbkdf2
+
+_PH = PasswordHasher(time_cost=2, memory_cost=19456, parallelism=1) if PasswordHasher else None
+
+def _hash_password_pbkdf2(password: str) -> str:
     salt = secrets.token_hex(16)
-    pwd_hash = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt.encode('utf-8'), 100000)
+    pwd_hash = _pbkdf2('sha256', password.encode('utf-8'), salt.encode('utf-8'), PBKDF2_ITERATIONS, PBKDF2_DKLEN)
     return f"{salt}${base64.b64encode(pwd_hash).decode('utf-8')}"
 
-def verify_password(password: str, hash_str: str) -> bool:
+def _verify_password_pbkdf2(password: str, hash_str: str) -> bool:
     parts = hash_str.split('$')
     if len(parts) != 2:
         return False
     salt, stored_hash = parts
-    pwd_hash = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt.encode('utf-8'), 100000)
+    pwd_hash = _pbkdf2('sha256', password.encode('utf-8'), salt.encode('utf-8'), PBKDF2_ITERATIONS, PBKDF2_DKLEN)
     return base64.b64encode(pwd_hash).decode('utf-8') == stored_hash
 
+def hash_password(password: str) -> str:
+    if not _PH:
+        return _hash_password_pbkdf2(password)
+    return _PH.hash(password)
+
+def verify_password(password: str, hash_str: str) -> bool:
+    if not hash_str.startswith('$argon2'):
+        return _verify_password_pbkdf2(password, hash_str)
+    if not _PH:
+        return False
+    try:
+        return _PH.verify(hash_str, password)
+    except (VerificationError, InvalidHashError):
+        return False
+
+def password_needs_rehash(hash_str: str) -> bool:
+    if not _PH:
+        return False
+    if not hash_str.startswith('$argon2'):
+        return True
+    return _PH.check_needs_rehash(hash_str)
+
 def create_jwt(user_id: int, email: str, expires_minutes: int = 60) -> str:
-    header = base64.urlsafe_b64encode(json.dumps({"alg": "HS256", "typ": "JWT"}).encode()).decode().rstrip('=')
     payload_data = {
         "user_id": user_id,
         "email": email,
         "exp": int((datetime.utcnow() + timedelta(minutes=expires_minutes)).timestamp())
     }
-    payload = base64.urlsafe_b64encode(json.dumps(payload_data).encode()).decode().rstrip('=')
-    signature_input = f"{header}.{payload}"
-    signature = base64.urlsafe_b64encode(
-        hashlib.sha256(f"{signature_input}{JWT_SECRET}".encode()).digest()
-    ).decode().rstrip('=')
-    return f"{header}.{payload}.{signature}"
+    signing_input = _JWT_HEADER_B64 + b'.' + base64.urlsafe_b64encode(orjson.dumps(payload_data)).rstrip(b'=')
+    signature = base64.urlsafe_b64encode(hmac.new(_JWT_KEY, signing_input, hashlib.sha256).digest()).rstrip(b'=')
+    return (signing_input + b'.' + signature).decode()
 
 def create_refresh_token() -> str:
     return secrets.token_urlsafe(32)
 
 def validate_email(email: str) -> bool:
-    pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-    return bool(re.match(pattern, email))
+    if not 3 <= len(email) <= 254:
+        return False
+    at = email.find('@')
+    if at <= 0 or at == len(email) - 1:
+        return False
+    return _EMAIL_RE.match(email) is not None
+
+_CORS_HEADERS = {
+    'Content-Type': 'application/json',
+    'Access-Control-Allow-Origin': '*'
+}
+
+_OPTIONS_RESPONSE = {
+    'statusCode': 200,
+    'headers': {
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+        'Access-Control-Allow-Headers': 'Content-Type, X-Auth-Token',
+        'Access-Control-Max-Age': '86400'
+    },
+    'body': ''
+}
+
+def _resp(status_code: int, data: Any) -> Dict[str, Any]:
+    return {'statusCode': status_code, 'headers': _CORS_HEADERS, 'body': orjson.dumps(data).decode()}
+
+DB_PING_AFTER_SECONDS = 30
+
+_POOL = None
+_IDLE_SINCE: Dict[int, float] = {}
+
+def _connection_alive(conn) -> bool:
+    if conn.closed:
+        return False
+    idle_since = _IDLE_SINCE.get(id(conn))
+    if idle_since is None or time.monotonic() - idle_since < DB_PING_AFTER_SECONDS:
+        return True
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
 
 def get_db_connection():
+    global _POOL
     if not psycopg2 or not DATABASE_URL:
         return None
-    return psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
+    if _POOL is None:
+        _POOL = ThreadedConnectionPool(1, 5, DATABASE_URL, cursor_factory=RealDictCursor)
+    conn = _POOL.getconn()
+    if not _connection_alive(conn):
+        conn.close()
+        release_db_connection(conn)
+        conn = _POOL.getconn()
+    return conn
+
+def release_db_connection(conn) -> None:
+    _POOL.putconn(conn, close=bool(conn.closed))
+    if conn.closed:
+        _IDLE_SINCE.pop(id(conn), None)
+    else:
+        _IDLE_SINCE[id(conn)] = time.monotonic()
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method: str = event.get('httpMethod', 'GET')
     
     if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-Auth-Token',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': ''
-        }
-    
-    headers = {
-        'Content-Type': 'application/json',
-        'Access-Control-Allow-Origin': '*'
-    }
+        return _OPTIONS_RESPONSE
     
+    conn = None
     try:
-        body_data = json.loads(event.get('body', '{}'))
+        body_data = orjson.loads(event['body']) if event.get('body') else {}
         action = body_data.get('action', '')
         
         conn = get_db_connection()
         if not conn:
-            return {
-                'statusCode': 500,
-                'headers': headers,
-                'body': json.dumps({'error': 'Database connection failed'})
-            }
+            return _resp(500, {'error': 'Database connection failed'})
         
         cursor = conn.cursor()
         
@@ -103,59 +254,45 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             full_name = body_data.get('fullName', '')
             
             if not validate_email(email):
-                return {
-                    'statusCode': 400,
-                    'headers': headers,
-                    'body': json.dumps({'error': 'Invalid email format'})
-                }
+                return _resp(400, {'error': 'Invalid email format'})
             
             if len(password) < 6:
-                return {
-                    'statusCode': 400,
-                    'headers': headers,
-                    'body': json.dumps({'error': 'Password must be at least 6 characters'})
-                }
-            
-            cursor.execute("SELECT id FROM users WHERE email = %s", (email,))
-            if cursor.fetchone():
-                return {
-                    'statusCode': 409,
-                    'headers': headers,
-                    'body': json.dumps({'error': 'Email already registered'})
-                }
+                return _resp(400, {'error': 'Password must be at least 6 characters'})
             
             password_hash = hash_password(password)
+            refresh_token = create_refresh_token()
             cursor.execute(
-                "INSERT INTO users (email, password_hash, full_name) VALUES (%s, %s, %s) RETURNING id, email, full_name",
-                (email, password_hash, full_name)
+                """
+                WITH new_user AS (
+                    INSERT INTO users (email, password_hash, full_name) VALUES (%s, %s, %s)
+                    ON CONFLICT (email) DO NOTHING
+                    RETURNING id, email, full_name
+                ), new_token AS (
+                    INSERT INTO refresh_tokens (user_id, token, expires_at)
+                    SELECT id, %s, %s FROM new_user
+                )
+                SELECT id, email, full_name FROM new_user
+                """,
+                (email, password_hash, full_name, refresh_token, datetime.utcnow() + timedelta(days=30))
             )
             user = cursor.fetchone()
-            conn.commit()
             
-            access_token = create_jwt(user['id'], user['email'], 60)
-            refresh_token = create_refresh_token()
+            if not user:
+                return _resp(409, {'error': 'Email already registered'})
             
-            cursor.execute(
-                "INSERT INTO refresh_tokens (user_id, token, expires_at) VALUES (%s, %s, %s)",
-                (user['id'], refresh_token, datetime.utcnow() + timedelta(days=30))
-            )
             conn.commit()
+            access_token = create_jwt(user['id'], user['email'], 60)
             cursor.close()
-            conn.close()
             
-            return {
-                'statusCode': 201,
-                'headers': headers,
-                'body': json.dumps({
-                    'user': {
-                        'id': user['id'],
-                        'email': user['email'],
-                        'fullName': user['full_name']
-                    },
-                    'accessToken': access_token,
-                    'refreshToken': refresh_token
-                })
-            }
+            return _resp(201, {
+                'user': {
+                    'id': user['id'],
+                    'email': user['email'],
+                    'fullName': user['full_name']
+                },
+                'accessToken': access_token,
+                'refreshToken': refresh_token
+            })
         
         elif action == 'login':
             email = body_data.get('email', '').strip().lower()
@@ -168,11 +305,13 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             user = cursor.fetchone()
             
             if not user or not user['password_hash'] or not verify_password(password, user['password_hash']):
-                return {
-                    'statusCode': 401,
-                    'headers': headers,
-                    'body': json.dumps({'error': 'Invalid email or password'})
-                }
+                return _resp(401, {'error': 'Invalid email or password'})
+            
+            if password_needs_rehash(user['password_hash']):
+                cursor.execute(
+                    "UPDATE users SET password_hash = %s, updated_at = NOW() WHERE id = %s",
+                    (hash_password(password), user['id'])
+                )
             
             access_token = create_jwt(user['id'], user['email'], 60)
             refresh_token = create_refresh_token()
@@ -183,80 +322,60 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             )
             conn.commit()
             cursor.close()
-            conn.close()
             
-            return {
-                'statusCode': 200,
-                'headers': headers,
-                'body': json.dumps({
-                    'user': {
-                        'id': user['id'],
-                        'email': user['email'],
-                        'fullName': user['full_name']
-                    },
-                    'accessToken': access_token,
-                    'refreshToken': refresh_token
-                })
-            }
+            return _resp(200, {
+                'user': {
+                    'id': user['id'],
+                    'email': user['email'],
+                    'fullName': user['full_name']
+                },
+                'accessToken': access_token,
+                'refreshToken': refresh_token
+            })
         
         elif action == 'google_login' and AUTH_GOOGLE_ENABLED:
             google_token = body_data.get('googleToken', '')
             
-            return {
-                'statusCode': 501,
-                'headers': headers,
-                'body': json.dumps({'error': 'Google OAuth not implemented yet'})
-            }
+            return _resp(501, {'error': 'Google OAuth not implemented yet'})
         
         elif action == 'refresh':
             refresh_token = body_data.get('refreshToken', '')
+            new_refresh_token = create_refresh_token()
             
             cursor.execute(
-                "SELECT rt.user_id, u.email, u.full_name FROM refresh_tokens rt JOIN users u ON rt.user_id = u.id WHERE rt.token = %s AND rt.revoked = false AND rt.expires_at > NOW()",
-                (refresh_token,)
+                """
+                WITH revoked AS (
+                    UPDATE refresh_tokens SET revoked = true
+                    WHERE token = %s AND revoked = false AND expires_at > NOW()
+                    RETURNING user_id
+                ), new_token AS (
+                    INSERT INTO refresh_tokens (user_id, token, expires_at)
+                    SELECT user_id, %s, %s FROM revoked
+                )
+                SELECT u.id AS user_id, u.email FROM revoked r JOIN users u ON u.id = r.user_id
+                """,
+                (refresh_token, new_refresh_token, datetime.utcnow() + timedelta(days=30))
             )
             token_data = cursor.fetchone()
             
             if not token_data:
-                return {
-                    'statusCode': 401,
-                    'headers': headers,
-                    'body': json.dumps({'error': 'Invalid or expired refresh token'})
-                }
+                return _resp(401, {'error': 'Invalid or expired refresh token'})
             
             access_token = create_jwt(token_data['user_id'], token_data['email'], 60)
-            new_refresh_token = create_refresh_token()
-            
-            cursor.execute("UPDATE refresh_tokens SET revoked = true WHERE token = %s", (refresh_token,))
-            cursor.execute(
-                "INSERT INTO refresh_tokens (user_id, token, expires_at) VALUES (%s, %s, %s)",
-                (token_data['user_id'], new_refresh_token, datetime.utcnow() + timedelta(days=30))
-            )
             conn.commit()
             cursor.close()
-            conn.close()
             
-            return {
-                'statusCode': 200,
-                'headers': headers,
-                'body': json.dumps({
-                    'accessToken': access_token,
-                    'refreshToken': new_refresh_token
-                })
-            }
+            return _resp(200, {
+                'accessToken': access_token,
+                'refreshToken': new_refresh_token
+            })
         
         else:
             cursor.close()
-            conn.close()
-            return {
-                'statusCode': 400,
-                'headers': headers,
-                'body': json.dumps({'error': 'Invalid action or Google OAuth disabled'})
-            }
+            return _resp(400, {'error': 'Invalid action or Google OAuth disabled'})
     
     except Exception as e:
-        return {
-            'statusCode': 500,
-            'headers': headers,
-            'body': json.dumps({'error': str(e)})
-        }
+        return _resp(500, {'error': str(e)})
+    finally:
+        if conn:
+            release_db_connection(conn)
@@ -4,65 +4,143 @@ Args: event with httpMethod, body (task data), headers (X-Auth-Token)
 Returns: HTTP response with task/project data or error
 """
 
-import json
 import os
-from typing import Dict, Any, Optional, List
-from datetime import datetime
-import base64
-import hashlib
+import re
+import time
+from typing import Dict, Any, Optional, List, Set
+import jwt
+import orjson
+from cachetools import TTLCache
 
 try:
     import psycopg2
     from psycopg2.extras import RealDictCursor
+    from psycopg2.pool import ThreadedConnectionPool
 except ImportError:
     psycopg2 = None
 
 DATABASE_URL = os.environ.get('DATABASE_URL')
 JWT_SECRET = os.environ.get('JWT_SECRET', 'default-secret-key')
+# Server-side prepared statements do not survive PgBouncer transaction pooling
+PGBOUNCER_TRANSACTION_MODE = os.environ.get('PGBOUNCER_TRANSACTION_MODE', 'false').lower() == 'true'
+_JWT_KEY = JWT_SECRET.encode()
+
+_JWT_CACHE = TTLCache(maxsize=1024, ttl=60)
 
 def verify_jwt(token: str) -> Optional[Dict[str, Any]]:
+    cached = _JWT_CACHE.get(token)
+    if cached is not None:
+        if cached.get('exp', 0) > time.time():
+            return cached
+        _JWT_CACHE.pop(token, None)
+    
     try:
-        parts = token.split('.')
-        if len(parts) != 3:
-            return None
-        
-        header, payload, signature = parts
-        signature_input = f"{header}.{payload}"
-        expected_signature = base64.urlsafe_b64encode(
-            hashlib.sha256(f"{signature_input}{JWT_SECRET}".encode()).digest()
-        ).decode().rstrip('=')
-        
-        if signature != expected_signature:
-            return None
-        
-        payload_data = json.loads(base64.urlsafe_b64decode(payload + '=='))
-        
-        if payload_data.get('exp', 0) < datetime.utcnow().timestamp():
-            return None
-        
-        return payload_data
-    except Exception:
+        payload_data = jwt.decode(token, _JWT_KEY, algorithms=['HS256'])
+    except jwt.InvalidTokenError:
         return None
+    
+    _JWT_CACHE[token] = payload_data
+    return payload_data
+
+def dumps(data: Any) -> str:
+    return orjson.dumps(data, default=str, option=orjson.OPT_PASSTHROUGH_DATETIME).decode()
+
+def parse_body(event: Dict[str, Any]) -> Dict[str, Any]:
+    body = event.get('body')
+    return orjson.loads(body) if body else {}
+
+_OPTIONS_RESPONSE = {
+    'statusCode': 200,
+    'headers': {
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
+        'Access-Control-Allow-Headers': 'Content-Type, X-Auth-Token',
+        'Access-Control-Max-Age': '86400'
+    },
+    'body': ''
+}
+
+DB_PING_AFTER_SECONDS = 30
+
+_POOL = None
+_IDLE_SINCE: Dict[int, float] = {}
+_PREPARED: Dict[int, Set[str]] = {}
+
+def _connection_alive(conn) -> bool:
+    if conn.closed:
+        return False
+    idle_since = _IDLE_SINCE.get(id(conn))
+    if idle_since is None or time.monotonic() - idle_since < DB_PING_AFTER_SECONDS:
+        return True
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
 
 def get_db_connection():
+    global _POOL
     if not psycopg2 or not DATABASE_URL:
         return None
-    return psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
+    if _POOL is None:
+        _POOL = ThreadedConnectionPool(1, 5, DATABASE_URL, cursor_factory=RealDictCursor)
+    conn = _POOL.getconn()
+    if not _connection_alive(conn):
+        conn.close()
+        release_db_connection(conn)
+        conn = _POOL.getconn()
+    return conn
+
+def release_db_connection(conn) -> None:
+    _POOL.putconn(conn, close=bool(conn.closed))
+    if conn.closed:
+        _IDLE_SINCE.pop(id(conn), None)
+        _PREPARED.pop(id(conn), None)
+    else:
+        _IDLE_SINCE[id(conn)] = time.monotonic()
+
+_PLACEHOLDER_RE = re.compile(r'\$\d+')
+
+def execute_statement(conn, cursor, name: str, sql: str, params: list) -> None:
+    if PGBOUNCER_TRANSACTION_MODE:
+        cursor.execute(_PLACEHOLDER_RE.sub('%s', sql), params)
+        return
+    prepared = _PREPARED.setdefault(id(conn), set())
+    if name not in prepared:
+        cursor.execute(f"PREPARE {name} AS {sql}")
+        prepared.add(name)
+    cursor.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+
+TASK_UPDATE_FIELDS = [
+    ('title', 'title'),
+    ('description', 'description'),
+    ('status', 'status'),
+    ('priority', 'priority'),
+    ('eisenhowerQuadrant', 'eisenhower_quadrant'),
+    ('kanbanColumn', 'kanban_column'),
+    ('dueAt', 'due_at'),
+    ('projectId', 'project_id'),
+]
+
+# Every updatable column takes a (provided, value) parameter pair so one fixed
+# statement covers any subset of fields, including explicit NULLs
+UPDATE_TASK_SQL = (
+    "UPDATE tasks SET "
+    + ", ".join(
+        f"{column} = CASE WHEN ${i * 2 + 1} THEN ${i * 2 + 2} ELSE {column} END"
+        for i, (_, column) in enumerate(TASK_UPDATE_FIELDS)
+    )
+    + f", updated_at = NOW() WHERE user_id = ${len(TASK_UPDATE_FIELDS) * 2 + 1}"
+    + f" AND id = ${len(TASK_UPDATE_FIELDS) * 2 + 2} RETURNING *"
+)
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method: str = event.get('httpMethod', 'GET')
     
     if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-Auth-Token',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': ''
-        }
+        return _OPTIONS_RESPONSE
     
     headers = {
         'Content-Type': 'application/json',
@@ -76,18 +154,19 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         return {
             'statusCode': 401,
             'headers': headers,
-            'body': json.dumps({'error': 'Unauthorized'})
+            'body': dumps({'error': 'Unauthorized'})
         }
     
     user_id = user_data['user_id']
     
+    conn = None
     try:
         conn = get_db_connection()
         if not conn:
             return {
                 'statusCode': 500,
                 'headers': headers,
-                'body': json.dumps({'error': 'Database connection failed'})
+                'body': dumps({'error': 'Database connection failed'})
             }
         
         cursor = conn.cursor()
@@ -102,38 +181,40 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 
                 status = params.get('status')
                 if status:
-                    filters.append(f"status = ${len(values) + 1}")
+                    filters.append("t.status = %s")
                     values.append(status)
                 
                 project_id = params.get('projectId')
                 if project_id:
-                    filters.append(f"project_id = ${len(values) + 1}")
+                    filters.append("t.project_id = %s")
                     values.append(int(project_id))
                 
                 priority = params.get('priority')
                 if priority:
-                    filters.append(f"priority = ${len(values) + 1}")
+                    filters.append("t.priority = %s")
                     values.append(priority)
                 
                 quadrant = params.get('quadrant')
                 if quadrant:
-                    filters.append(f"eisenhower_quadrant = ${len(values) + 1}")
+                    filters.append("t.eisenhower_quadrant = %s")
                     values.append(quadrant)
                 
-                where_clause = "user_id = %s"
-                if filters:
-                    where_clause += " AND " + " AND ".join(filters).replace('$', '%s').replace('%s1', '%s').replace('%s2', '%s').replace('%s3', '%s').replace('%s4', '%s')
+                where_clause = " AND ".join(["t.user_id = %s"] + filters)
                 
                 cursor.execute(
                     f"""
                     SELECT t.*, 
                            json_build_object('id', p.id, 'name', p.name, 'color', p.color) as project,
                            json_build_object('id', c.id, 'name', c.name, 'icon', c.icon) as context,
-                           (SELECT json_agg(json_build_object('id', s.id, 'title', s.title, 'completed', s.completed, 'sortOrder', s.sort_order))
-                            FROM subtasks s WHERE s.task_id = t.id ORDER BY s.sort_order) as subtasks
+                           sub.subtasks
                     FROM tasks t
                     LEFT JOIN projects p ON t.project_id = p.id
                     LEFT JOIN contexts c ON t.context_id = c.id
+                    LEFT JOIN LATERAL (
+                        SELECT json_agg(json_build_object('id', s.id, 'title', s.title, 'completed', s.completed, 'sortOrder', s.sort_order)
+                                        ORDER BY s.sort_order) as subtasks
+                        FROM subtasks s WHERE s.task_id = t.id
+                    ) sub ON true
                     WHERE {where_clause}
                     ORDER BY t.created_at DESC
                     LIMIT 100
@@ -145,16 +226,24 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 return {
                     'statusCode': 200,
                     'headers': headers,
-                    'body': json.dumps([dict(task) for task in tasks], default=str)
+                    'body': dumps(tasks)
                 }
             
             elif resource == 'projects':
                 cursor.execute(
                     """
-                    SELECT p.*, 
-                           (SELECT COUNT(*) FROM tasks WHERE project_id = p.id) as task_count
-                    FROM projects p
-                    WHERE p.owner_id = %s OR p.id IN (SELECT project_id FROM project_members WHERE user_id = %s)
+                    WITH visible AS (
+                        SELECT * FROM projects
+                        WHERE owner_id = %s OR id IN (SELECT project_id FROM project_members WHERE user_id = %s)
+                    )
+                    SELECT p.*, COALESCE(tc.task_count, 0) as task_count
+                    FROM visible p
+                    LEFT JOIN (
+                        SELECT project_id, COUNT(*) as task_count
+                        FROM tasks
+                        WHERE project_id IN (SELECT id FROM visible)
+                        GROUP BY project_id
+                    ) tc ON tc.project_id = p.id
                     ORDER BY p.created_at DESC
                     """,
                     (user_id, user_id)
@@ -164,7 +253,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 return {
                     'statusCode': 200,
                     'headers': headers,
-                    'body': json.dumps([dict(p) for p in projects], default=str)
+                    'body': dumps(projects)
                 }
             
             elif resource == 'contexts':
@@ -174,11 +263,11 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 return {
                     'statusCode': 200,
                     'headers': headers,
-                    'body': json.dumps([dict(c) for c in contexts], default=str)
+                    'body': dumps(contexts)
                 }
         
         elif method == 'POST':
-            body_data = json.loads(event.get('body', '{}'))
+            body_data = parse_body(event)
             resource = body_data.get('resource', 'task')
             
             if resource == 'task':
@@ -187,7 +276,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     return {
                         'statusCode': 400,
                         'headers': headers,
-                        'body': json.dumps({'error': 'Title is required'})
+                        'body': dumps({'error': 'Title is required'})
                     }
                 
                 cursor.execute(
@@ -221,7 +310,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 return {
                     'statusCode': 201,
                     'headers': headers,
-                    'body': json.dumps(dict(task), default=str)
+                    'body': dumps(task)
                 }
             
             elif resource == 'project':
@@ -230,7 +319,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     return {
                         'statusCode': 400,
                         'headers': headers,
-                        'body': json.dumps({'error': 'Project name is required'})
+                        'body': dumps({'error': 'Project name is required'})
                     }
                 
                 cursor.execute(
@@ -247,7 +336,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 return {
                     'statusCode': 201,
                     'headers': headers,
-                    'body': json.dumps(dict(project), default=str)
+                    'body': dumps(project)
                 }
             
             elif resource == 'context':
@@ -256,7 +345,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     return {
                         'statusCode': 400,
                         'headers': headers,
-                        'body': json.dumps({'error': 'Context name is required'})
+                        'body': dumps({'error': 'Context name is required'})
                     }
                 
                 cursor.execute(
@@ -269,67 +358,33 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 return {
                     'statusCode': 201,
                     'headers': headers,
-                    'body': json.dumps(dict(ctx), default=str)
+                    'body': dumps(ctx)
                 }
         
         elif method == 'PUT':
-            body_data = json.loads(event.get('body', '{}'))
+            body_data = parse_body(event)
             task_id = body_data.get('id')
             
             if not task_id:
                 return {
                     'statusCode': 400,
                     'headers': headers,
-                    'body': json.dumps({'error': 'Task ID is required'})
+                    'body': dumps({'error': 'Task ID is required'})
                 }
             
-            update_fields = []
             values = []
-            
-            if 'title' in body_data:
-                update_fields.append(f"title = %s")
-                values.append(body_data['title'])
-            if 'description' in body_data:
-                update_fields.append(f"description = %s")
-                values.append(body_data['description'])
-            if 'status' in body_data:
-                update_fields.append(f"status = %s")
-                values.append(body_data['status'])
-            if 'priority' in body_data:
-                update_fields.append(f"priority = %s")
-                values.append(body_data['priority'])
-            if 'eisenhowerQuadrant' in body_data:
-                update_fields.append(f"eisenhower_quadrant = %s")
-                values.append(body_data['eisenhowerQuadrant'])
-            if 'kanbanColumn' in body_data:
-                update_fields.append(f"kanban_column = %s")
-                values.append(body_data['kanbanColumn'])
-            if 'dueAt' in body_data:
-                update_fields.append(f"due_at = %s")
-                values.append(body_data['dueAt'])
-            if 'projectId' in body_data:
-                update_fields.append(f"project_id = %s")
-                values.append(body_data['projectId'])
-            
-            update_fields.append("updated_at = NOW()")
-            
+            for key, _ in TASK_UPDATE_FIELDS:
+                values.extend([key in body_data, body_data.get(key)])
             values.extend([user_id, task_id])
             
-            cursor.execute(
-                f"""
-                UPDATE tasks SET {', '.join(update_fields)}
-                WHERE user_id = %s AND id = %s
-                RETURNING *
-                """,
-                values
-            )
+            execute_statement(conn, cursor, 'update_task', UPDATE_TASK_SQL, values)
             task = cursor.fetchone()
             
             if not task:
                 return {
                     'statusCode': 404,
                     'headers': headers,
-                    'body': json.dumps({'error': 'Task not found'})
+                    'body': dumps({'error': 'Task not found'})
                 }
             
             conn.commit()
@@ -337,21 +392,23 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             return {
                 'statusCode': 200,
                 'headers': headers,
-                'body': json.dumps(dict(task), default=str)
+                'body': dumps(task)
             }
         
         cursor.close()
-        conn.close()
         
         return {
             'statusCode': 405,
             'headers': headers,
-            'body': json.dumps({'error': 'Method not allowed'})
+            'body': dumps({'error': 'Method not allowed'})
         }
     
     except Exception as e:
         return {
             'statusCode': 500,
             'headers': headers,
-            'body': json.dumps({'error': str(e)})
+            'body': dumps({'error': str(e)})
         }
+    finally:
+        if conn:
+            release_db_connection(conn)
@@ -4,58 +4,387 @@ Args: event with httpMethod, body (Telegram webhook updates)
 Returns: HTTP response acknowledging webhook or command results
 """
 
+import functools
+import hmac
 import json
+import logging
 import os
-from typing import Dict, Any, Optional
-from datetime import datetime
+import re
+import time
+from typing import Dict, Any, List, Set
+from cachetools import TTLCache
 
 try:
-    import psycopg2
-    from psycopg2.extras import RealDictCursor
-    import requests
+    import orjson
 except ImportError:
-    psycopg2 = None
-    requests = None
+    orjson = None
 
 DATABASE_URL = os.environ.get('DATABASE_URL')
 TELEGRAM_BOT_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN', '')
+TELEGRAM_WEBHOOK_SECRET = os.environ.get('TELEGRAM_WEBHOOK_SECRET', '')
+# Server-side prepared statements do not survive PgBouncer transaction pooling
+PGBOUNCER_TRANSACTION_MODE = os.environ.get('PGBOUNCER_TRANSACTION_MODE', 'false').lower() == 'true'
+
+logger = logging.getLogger(__name__)
+
+_OPTIONS_RESPONSE = {
+    'statusCode': 200,
+    'headers': {
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Allow-Methods': 'POST, OPTIONS',
+        'Access-Control-Allow-Headers': 'Content-Type',
+        'Access-Control-Max-Age': '86400'
+    },
+    'body': ''
+}
+
+# psycopg2 and requests are imported on first use so cold starts serving
+# OPTIONS, 405 or 401 responses do not pay for loading them
+@functools.lru_cache(maxsize=None)
+def _psycopg():
+    try:
+        import psycopg2
+        import psycopg2.extensions
+        import psycopg2.extras
+        import psycopg2.pool
+    except ImportError:
+        return None
+    return psycopg2
+
+@functools.lru_cache(maxsize=None)
+def _requests():
+    try:
+        import requests
+        import requests.adapters
+    except ImportError:
+        return None
+    return requests
+
+def _db_errors() -> tuple:
+    psycopg2 = _psycopg()
+    return (psycopg2.Error,) if psycopg2 else ()
+
+DB_PING_AFTER_SECONDS = 30
+
+_POOL = None
+_IDLE_SINCE: Dict[int, float] = {}
+_PREPARED: Dict[int, Set[str]] = {}
+
+def _connection_alive(conn) -> bool:
+    if conn.closed:
+        return False
+    idle_since = _IDLE_SINCE.get(id(conn))
+    if idle_since is None or time.monotonic() - idle_since < DB_PING_AFTER_SECONDS:
+        return True
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except _psycopg().Error:
+        return False
 
 def get_db_connection():
+    global _POOL
+    psycopg2 = _psycopg()
     if not psycopg2 or not DATABASE_URL:
         return None
-    return psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
+    if _POOL is None:
+        _POOL = psycopg2.pool.ThreadedConnectionPool(1, 4, DATABASE_URL, cursor_factory=psycopg2.extras.RealDictCursor)
+    conn = _POOL.getconn()
+    if not _connection_alive(conn):
+        conn.close()
+        release_db_connection(conn)
+        conn = _POOL.getconn()
+    return conn
 
-def send_telegram_message(chat_id: str, text: str, parse_mode: str = 'HTML'):
-    if not TELEGRAM_BOT_TOKEN or not requests:
+def release_db_connection(conn) -> None:
+    _POOL.putconn(conn, close=bool(conn.closed))
+    if conn.closed:
+        _IDLE_SINCE.pop(id(conn), None)
+        _PREPARED.pop(id(conn), None)
+    else:
+        _IDLE_SINCE[id(conn)] = time.monotonic()
+
+STATEMENTS = {
+    'tg_lookup': "SELECT user_id FROM integrations_telegram WHERE chat_id = $1",
+    'tg_new': """
+        WITH u AS (SELECT user_id FROM integrations_telegram WHERE chat_id = $1 AND enabled = true)
+        INSERT INTO tasks (user_id, title, status)
+        SELECT u.user_id, t.title, 'inbox'
+        FROM u, UNNEST($2::text[]) WITH ORDINALITY AS t(title, n)
+        ORDER BY t.n
+        RETURNING id, user_id
+    """,
+    'tg_new_for_user': """
+        INSERT INTO tasks (user_id, title, status)
+        SELECT $1, t.title, 'inbox'
+        FROM UNNEST($2::text[]) WITH ORDINALITY AS t(title, n)
+        ORDER BY t.n
+        RETURNING id, user_id
+    """,
+    'tg_list': """
+        SELECT i.user_id, t.id, t.title, t.priority, t.due_at
+        FROM integrations_telegram i
+        LEFT JOIN LATERAL (
+            SELECT id, title, priority, due_at
+            FROM tasks
+            WHERE user_id = i.user_id AND status NOT IN ('done', 'archived')
+            ORDER BY due_at ASC NULLS LAST, created_at DESC
+            LIMIT $2 OFFSET $3
+        ) t ON true
+        WHERE i.chat_id = $1 AND i.enabled = true
+    """,
+    'tg_list_for_user': """
+        SELECT id, title, priority, due_at
+        FROM tasks
+        WHERE user_id = $1 AND status NOT IN ('done', 'archived')
+        ORDER BY due_at ASC NULLS LAST, created_at DESC
+        LIMIT $2 OFFSET $3
+    """,
+}
+
+# chat_id -> user_id of enabled integrations; lets warm instances skip the
+# integrations_telegram join for repeated commands from the same chat
+CHAT_USER_CACHE = TTLCache(maxsize=1024, ttl=60)
+
+LIST_PAGE_SIZE = 10
+# Two pages plus one row, so a full second page can tell whether a third exists
+LIST_FETCH_ROWS = LIST_PAGE_SIZE * 2 + 1
+# chat_id -> (user_id, offset, prefetched rows, exhausted) for the page /more shows next;
+# /list and /more fetch two pages at a time so the following /more needs no query.
+# Same TTL as CHAT_USER_CACHE: prefetched rows are only served while the chat's
+# cached user still matches
+LIST_PAGE_CACHE = TTLCache(maxsize=1024, ttl=60)
+
+_PLACEHOLDER_RE = re.compile(r'\$\d+')
+
+def execute_statement(conn, cursor, name: str, params: tuple) -> None:
+    sql = STATEMENTS[name]
+    if PGBOUNCER_TRANSACTION_MODE:
+        cursor.execute(_PLACEHOLDER_RE.sub('%s', sql), params)
+        return
+    prepared = _PREPARED.setdefault(id(conn), set())
+    if name not in prepared:
+        cursor.execute(f"PREPARE {name} AS {sql}")
+        prepared.add(name)
+    cursor.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+
+def dumps(data: Any) -> str:
+    if orjson:
+        return orjson.dumps(data).decode()
+    return json.dumps(data)
+
+def loads(body: str) -> Any:
+    if orjson:
+        return orjson.loads(body)
+    return json.loads(body)
+
+def webhook_secret_valid(event: Dict[str, Any]) -> bool:
+    if not TELEGRAM_WEBHOOK_SECRET:
+        return True
+    for name, value in (event.get('headers') or {}).items():
+        if name.lower() == 'x-telegram-bot-api-secret-token':
+            return hmac.compare_digest(str(value).encode(), TELEGRAM_WEBHOOK_SECRET.encode())
+    return False
+
+_SESSION = None
+
+def get_session():
+    global _SESSION
+    if _SESSION is None:
+        requests = _requests()
+        if not requests:
+            return None
+        _SESSION = requests.Session()
+        _SESSION.mount('https://', requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=0))
+    return _SESSION
+
+def _call_telegram(method: str, payload: Dict[str, Any]) -> bool:
+    if not TELEGRAM_BOT_TOKEN:
+        return False
+    session = get_session()
+    if not session:
         return False
     
-    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
-    payload = {
+    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/{method}"
+    try:
+        response = session.post(url, json=payload, timeout=5)
+    except _requests().RequestException:
+        logger.exception("Telegram %s failed for chat %s", method, payload.get('chat_id'))
+        return False
+    
+    if response.status_code != 200:
+        logger.warning("Telegram %s returned %s for chat %s", method, response.status_code, payload.get('chat_id'))
+        return False
+    return True
+
+def send_telegram_message(chat_id: str, text: str, parse_mode: str = 'HTML'):
+    return _call_telegram('sendMessage', {
         'chat_id': chat_id,
         'text': text,
         'parse_mode': parse_mode
-    }
+    })
+
+START_CONNECTED_TEXT = (
+    "✅ Ваш аккаунт уже подключен!\n\n"
+    "Доступные команды:\n"
+    "/new - создать задачу\n"
+    "/list - показать задачи\n"
+    "/more - ещё задачи\n"
+    "/help - справка"
+)
+START_UNLINKED_TEMPLATE = (
+    "👋 Привет! Я бот для управления задачами.\n\n"
+    "Ваш Chat ID: <code>{chat_id}</code>\n\n"
+    "Скопируйте Chat ID и подключите бота в настройках приложения."
+)
+HELP_TEXT = (
+    "<b>📖 Команды бота:</b>\n\n"
+    "/start - подключение аккаунта\n"
+    "/new Текст - создать задачу (каждая строка - отдельная задача)\n"
+    "/list - показать активные задачи\n"
+    "/more - следующие задачи после /list\n"
+    "/help - эта справка"
+)
+NEW_USAGE_TEXT = "Использование: /new Текст задачи"
+NOT_LINKED_TEXT = "❌ Сначала подключите бота в приложении"
+NO_TASKS_TEXT = "✨ Задач нет! Всё сделано."
+NO_MORE_TASKS_TEXT = "Больше задач нет. Используйте /list"
+LIST_MORE_HINT = "\nЕщё задачи: /more"
+UNKNOWN_COMMAND_TEXT = "Не понял команду. Используйте /help"
+PRIORITY_EMOJI = {'high': '🔴', 'medium': '🟡', 'low': '🟢'}
+
+def cmd_start(conn, cursor, chat_id: str, arg: str) -> str:
+    CHAT_USER_CACHE.pop(chat_id, None)
+    LIST_PAGE_CACHE.pop(chat_id, None)
+    execute_statement(conn, cursor, 'tg_lookup', (chat_id,))
+    if cursor.fetchone():
+        return START_CONNECTED_TEXT
+    return START_UNLINKED_TEMPLATE.format(chat_id=chat_id)
+
+def bulk_create_tasks(conn, cursor, chat_id: str, titles: List[str]) -> List[int]:
+    user_id = CHAT_USER_CACHE.get(chat_id)
+    if user_id is None:
+        execute_statement(conn, cursor, 'tg_new', (chat_id, titles))
+    else:
+        execute_statement(conn, cursor, 'tg_new_for_user', (user_id, titles))
+    rows = cursor.fetchall()
+    if rows:
+        CHAT_USER_CACHE[chat_id] = rows[0]['user_id']
+    return [row['id'] for row in rows]
+
+def cmd_new(conn, cursor, chat_id: str, arg: str) -> str:
+    titles = [line.strip() for line in arg.splitlines() if line.strip()]
+    if not titles:
+        return NEW_USAGE_TEXT
     
-    try:
-        response = requests.post(url, json=payload, timeout=5)
-        return response.status_code == 200
-    except Exception:
+    task_ids = bulk_create_tasks(conn, cursor, chat_id, titles)
+    if not task_ids:
+        return NOT_LINKED_TEXT
+    
+    conn.commit()
+    if len(task_ids) == 1:
+        return f"✅ Задача создана! ID: {task_ids[0]}"
+    return f"✅ Создано задач: {len(task_ids)}. ID: {', '.join(str(task_id) for task_id in task_ids)}"
+
+def _format_task_list(tasks: List[tuple], has_more: bool) -> str:
+    parts = ["📋 <b>Ваши задачи:</b>\n\n"]
+    for task_id, title, priority, due_at in tasks:
+        parts.append(f"{PRIORITY_EMOJI.get(priority, '⚪')} <b>#{task_id}</b> {title}\n")
+        if due_at:
+            parts.append(f"   📅 {due_at}\n")
+    if has_more:
+        parts.append(LIST_MORE_HINT)
+    return ''.join(parts)
+
+def _remember_next_page(chat_id: str, user_id: int, offset: int, rows: List[tuple]) -> bool:
+    prefetched = rows[LIST_PAGE_SIZE:LIST_PAGE_SIZE * 2]
+    if not prefetched:
+        LIST_PAGE_CACHE.pop(chat_id, None)
         return False
+    exhausted = len(rows) < LIST_FETCH_ROWS
+    LIST_PAGE_CACHE[chat_id] = (user_id, offset + LIST_PAGE_SIZE, prefetched, exhausted)
+    return True
+
+def _fetch_task_page(conn, cursor, chat_id: str, offset: int):
+    user_id = CHAT_USER_CACHE.get(chat_id)
+    if user_id is None:
+        # One row per task, a single row with NULL task columns when the linked
+        # user has none, and no rows at all when the chat is not linked
+        execute_statement(conn, cursor, 'tg_list', (chat_id, LIST_FETCH_ROWS, offset))
+        rows = cursor.fetchall()
+        if not rows:
+            return None, []
+        user_id = rows[0][0]
+        CHAT_USER_CACHE[chat_id] = user_id
+        return user_id, [row[1:] for row in rows if row[1] is not None]
+    execute_statement(conn, cursor, 'tg_list_for_user', (user_id, LIST_FETCH_ROWS, offset))
+    return user_id, cursor.fetchall()
+
+def cmd_list(conn, cursor, chat_id: str, arg: str) -> str:
+    user_id, tasks = _fetch_task_page(conn, cursor, chat_id, 0)
+    if user_id is None:
+        LIST_PAGE_CACHE.pop(chat_id, None)
+        return NOT_LINKED_TEXT
+    if not tasks:
+        LIST_PAGE_CACHE.pop(chat_id, None)
+        return NO_TASKS_TEXT
+    
+    has_more = _remember_next_page(chat_id, user_id, 0, tasks)
+    return _format_task_list(tasks[:LIST_PAGE_SIZE], has_more)
+
+def cmd_more(conn, cursor, chat_id: str, arg: str) -> str:
+    page = LIST_PAGE_CACHE.get(chat_id)
+    if page is None:
+        return NO_MORE_TASKS_TEXT
+    
+    page_user_id, offset, tasks, exhausted = page
+    if tasks and CHAT_USER_CACHE.get(chat_id) == page_user_id:
+        if exhausted:
+            LIST_PAGE_CACHE.pop(chat_id, None)
+        else:
+            LIST_PAGE_CACHE[chat_id] = (page_user_id, offset + len(tasks), [], False)
+        return _format_task_list(tasks, not exhausted)
+    
+    # Either the prefetched page is used up or the chat's user has to be checked
+    # again, so the integration may have been disabled or relinked since /list
+    user_id, tasks = _fetch_task_page(conn, cursor, chat_id, offset)
+    if user_id is None:
+        LIST_PAGE_CACHE.pop(chat_id, None)
+        return NOT_LINKED_TEXT
+    if user_id != page_user_id or not tasks:
+        LIST_PAGE_CACHE.pop(chat_id, None)
+        return NO_MORE_TASKS_TEXT
+    
+    has_more = _remember_next_page(chat_id, user_id, offset, tasks)
+    return _format_task_list(tasks[:LIST_PAGE_SIZE], has_more)
+
+def cmd_help(conn, cursor, chat_id: str, arg: str) -> str:
+    return HELP_TEXT
+
+COMMANDS = {
+    '/start': cmd_start,
+    '/new': cmd_new,
+    '/list': cmd_list,
+    '/more': cmd_more,
+    '/help': cmd_help,
+}
+
+# Command token, optional @botname suffix used in group chats, then the argument
+COMMAND_RE = re.compile(r'^\s*(/\w+)(?:@\w+)?(?:\s+(.*))?$', re.DOTALL)
+
+# Commands that reply without touching the database
+STATELESS_COMMANDS = {cmd_help}
+
+# Commands that read rows positionally; a plain tuple cursor skips building a dict per row
+TUPLE_CURSOR_COMMANDS = {cmd_list, cmd_more}
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method: str = event.get('httpMethod', 'POST')
     
     if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': ''
-        }
+        return _OPTIONS_RESPONSE
     
     headers = {
         'Content-Type': 'application/json',
@@ -66,128 +395,88 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         return {
             'statusCode': 405,
             'headers': headers,
-            'body': json.dumps({'error': 'Method not allowed'})
+            'body': dumps({'error': 'Method not allowed'})
+        }
+    
+    if not webhook_secret_valid(event):
+        return {
+            'statusCode': 401,
+            'headers': headers,
+            'body': dumps({'error': 'Unauthorized'})
         }
     
     try:
-        body_data = json.loads(event.get('body', '{}'))
-        
+        body_data = loads(event.get('body') or '{}')
+    except ValueError:
+        body_data = None
+    if not isinstance(body_data, dict):
+        logger.warning("Rejected webhook with malformed JSON body")
+        return {
+            'statusCode': 400,
+            'headers': headers,
+            'body': dumps({'error': 'Invalid JSON body'})
+        }
+    
+    conn = None
+    try:
         if 'message' in body_data:
             message = body_data['message']
-            chat_id = str(message.get('chat', {}).get('id', ''))
+            chat = message.get('chat')
+            chat_id = str(chat.get('id', '')) if chat else ''
             text = message.get('text', '')
-            user = message.get('from', {})
-            
-            conn = get_db_connection()
-            if not conn:
-                return {'statusCode': 200, 'headers': headers, 'body': json.dumps({'ok': True})}
             
-            cursor = conn.cursor()
+            match = COMMAND_RE.match(text)
+            command = COMMANDS.get(match.group(1)) if match else None
+            arg = (match.group(2) or '').strip() if match else ''
             
-            if text.startswith('/start'):
-                cursor.execute(
-                    "SELECT user_id FROM integrations_telegram WHERE chat_id = %s",
-                    (chat_id,)
-                )
-                existing = cursor.fetchone()
+            if not command:
+                reply = UNKNOWN_COMMAND_TEXT
+            elif command in STATELESS_COMMANDS:
+                reply = command(None, None, chat_id, arg)
+            else:
+                conn = get_db_connection()
+                if not conn:
+                    return {'statusCode': 200, 'headers': headers, 'body': dumps({'ok': True})}
                 
-                if existing:
-                    send_telegram_message(
-                        chat_id,
-                        "✅ Ваш аккаунт уже подключен!\n\n"
-                        "Доступные команды:\n"
-                        "/new - создать задачу\n"
-                        "/list - показать задачи\n"
-                        "/help - справка"
-                    )
+                if command in TUPLE_CURSOR_COMMANDS:
+                    cursor = conn.cursor(cursor_factory=_psycopg().extensions.cursor)
                 else:
-                    send_telegram_message(
-                        chat_id,
-                        f"👋 Привет! Я бот для управления задачами.\n\n"
-                        f"Ваш Chat ID: <code>{chat_id}</code>\n\n"
-                        f"Скопируйте Chat ID и подключите бота в настройках приложения."
-                    )
-            
-            elif text.startswith('/new'):
-                cursor.execute(
-                    "SELECT user_id FROM integrations_telegram WHERE chat_id = %s AND enabled = true",
-                    (chat_id,)
-                )
-                integration = cursor.fetchone()
+                    cursor = conn.cursor()
+                reply = command(conn, cursor, chat_id, arg)
                 
-                if not integration:
-                    send_telegram_message(chat_id, "❌ Сначала подключите бота в приложении")
-                else:
-                    task_text = text[4:].strip()
-                    if task_text:
-                        cursor.execute(
-                            "INSERT INTO tasks (user_id, title, status) VALUES (%s, %s, %s) RETURNING id",
-                            (integration['user_id'], task_text, 'inbox')
-                        )
-                        task = cursor.fetchone()
-                        conn.commit()
-                        send_telegram_message(chat_id, f"✅ Задача создана! ID: {task['id']}")
-                    else:
-                        send_telegram_message(chat_id, "Использование: /new Текст задачи")
+                # Hand the connection back before the Telegram API call so it is not
+                # held for the duration of an HTTPS round trip
+                cursor.close()
+                release_db_connection(conn)
+                conn = None
             
-            elif text.startswith('/list'):
-                cursor.execute(
-                    "SELECT user_id FROM integrations_telegram WHERE chat_id = %s AND enabled = true",
-                    (chat_id,)
-                )
-                integration = cursor.fetchone()
-                
-                if not integration:
-                    send_telegram_message(chat_id, "❌ Сначала подключите бота в приложении")
-                else:
-                    cursor.execute(
-                        """
-                        SELECT id, title, status, priority, due_at
-                        FROM tasks
-                        WHERE user_id = %s AND status != 'done' AND status != 'archived'
-                        ORDER BY due_at ASC NULLS LAST, created_at DESC
-                        LIMIT 10
-                        """,
-                        (integration['user_id'],)
-                    )
-                    tasks = cursor.fetchall()
-                    
-                    if tasks:
-                        message_text = "📋 <b>Ваши задачи:</b>\n\n"
-                        for task in tasks:
-                            priority_emoji = {'high': '🔴', 'medium': '🟡', 'low': '🟢'}.get(task['priority'], '⚪')
-                            message_text += f"{priority_emoji} <b>#{task['id']}</b> {task['title']}\n"
-                            if task['due_at']:
-                                message_text += f"   📅 {task['due_at']}\n"
-                        send_telegram_message(chat_id, message_text)
-                    else:
-                        send_telegram_message(chat_id, "✨ Задач нет! Всё сделано.")
-            
-            elif text.startswith('/help'):
-                send_telegram_message(
-                    chat_id,
-                    "<b>📖 Команды бота:</b>\n\n"
-                    "/start - подключение аккаунта\n"
-                    "/new Текст - создать задачу\n"
-                    "/list - показать активные задачи\n"
-                    "/help - эта справка"
-                )
-            
-            else:
-                send_telegram_message(chat_id, "Не понял команду. Используйте /help")
-            
-            cursor.close()
-            conn.close()
+            send_telegram_message(chat_id, reply)
         
         return {
             'statusCode': 200,
             'headers': headers,
-            'body': json.dumps({'ok': True})
+            'body': dumps({'ok': True})
+        }
+    
+    except _db_errors() as e:
+        # Acknowledge anyway: Telegram retrying the update would not help while the
+        # database is failing, but the error must still reach the function logs
+        logger.exception("Database error while handling Telegram update")
+        return {
+            'statusCode': 200,
+            'headers': headers,
+            'body': dumps({'ok': True, 'error': str(e)})
         }
     
-    except Exception as e:
+    except Exception:
+        # Any non-2xx reply makes Telegram redeliver the same update, so a bad update
+        # is logged and acknowledged instead of being retried indefinitely
+        logger.exception("Failed to handle Telegram update")
         return {
             'statusCode': 200,
             'headers': headers,
-            'body': json.dumps({'ok': True, 'error': str(e)})
+            'body': dumps({'ok': True})
         }
+    finally:
+        if conn:
+            release_db_connection(conn)
@@ -0,0 +1,2 @@
+-- Composite index for per-task subtask aggregation ordered by sort_order
+CREATE INDEX IF NOT EXISTS idx_subtasks_task_sort ON subtasks(task_id, sort_order);
@@ -0,0 +1,2 @@
+-- Partial index matching the Telegram /list query: open tasks per user in display order
+CREATE INDEX IF NOT EXISTS idx_tasks_user_open_due ON tasks(user_id, due_at ASC NULLS LAST, created_at DESC) WHERE status NOT IN ('done', 'archived');